@@ -7,7 +7,10 @@ import requests
 from openai import OpenAI
 import os
 import base64
+import threading
 from google_calendar import calendar_manager
+from db_maintenance import StorageMaintenanceManager
+from photo_index import PhotoHashIndex, compute_dhash, encode_hash
 
 # === Configuration: Insert your keys here ===
 FLASK_SECRET = "your_flask_secret_here"
@@ -27,8 +30,17 @@ client = OpenAI(api_key=OPENAI_API_KEY)
 # Database file path
 DB_PATH = "integrated_diary.db"
 
+# Background chunked deletes and incremental vacuum
+maintenance_manager = StorageMaintenanceManager(DB_PATH)
+
+# Perceptual hashes for near-duplicate photo detection
+photo_index = PhotoHashIndex(DB_PATH, maintenance_manager)
+
 # Initialize the database and create tables if they don't exist
 def init_db():
+    # Must run before any tables exist so new databases start out incremental
+    maintenance_manager.migrate()
+    
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
@@ -58,12 +70,38 @@ def init_db():
         '''
     )
     
+    # Create photo hashes table (id matches photos.id)
+    cursor.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS photo_hashes (
+            id INTEGER PRIMARY KEY,
+            dhash TEXT
+        )
+        '''
+    )
+    
     conn.commit()
     conn.close()
 
 # Ensure database is ready on startup
 init_db()
 
+# Background threads start on the first request so that only the serving
+# process runs them (the debug reloader also imports this module).
+background_lock = threading.Lock()
+background_started = False
+
+@app.before_request
+def start_background_workers():
+    global background_started
+    if background_started:
+        return
+    with background_lock:
+        if not background_started:
+            maintenance_manager.start()
+            photo_index.start_backfill()
+            background_started = True
+
 # API Routes for React frontend
 
 @app.route('/api/health', methods=['GET'])
@@ -94,7 +132,8 @@ def google_calendar_status():
 def get_songs():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
-    cursor.execute("SELECT id, title, artist, listened_at FROM songs ORDER BY listened_at DESC")
+    visible, params = maintenance_manager.visible_filter('songs')
+    cursor.execute(f"SELECT id, title, artist, listened_at FROM songs WHERE {visible} ORDER BY listened_at DESC", params)
     rows = cursor.fetchall()
     conn.close()
     
@@ -113,7 +152,8 @@ def get_songs():
 def get_photos():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
-    cursor.execute("SELECT id, data_url, label, taken_at FROM photos ORDER BY taken_at DESC")
+    visible, params = maintenance_manager.visible_filter('photos')
+    cursor.execute(f"SELECT id, data_url, label, taken_at FROM photos WHERE {visible} ORDER BY taken_at DESC", params)
     rows = cursor.fetchall()
     conn.close()
     
@@ -136,11 +176,13 @@ def get_calendar_data():
     cursor = conn.cursor()
     
     # Get songs
-    cursor.execute("SELECT title, artist, listened_at FROM songs ORDER BY listened_at DESC")
+    visible, params = maintenance_manager.visible_filter('songs')
+    cursor.execute(f"SELECT title, artist, listened_at FROM songs WHERE {visible} ORDER BY listened_at DESC", params)
     songs = cursor.fetchall()
     
     # Get photos
-    cursor.execute("SELECT data_url, label, taken_at FROM photos ORDER BY taken_at DESC")
+    visible, params = maintenance_manager.visible_filter('photos')
+    cursor.execute(f"SELECT data_url, label, taken_at FROM photos WHERE {visible} ORDER BY taken_at DESC", params)
     photos = cursor.fetchall()
     
     conn.close()
@@ -244,6 +286,7 @@ def add_photo():
         
         data_url = data.get('data_url')
         label = data.get('label', '')
+        merge_duplicates = data.get('merge_duplicates', False)
         
         print(f"Received photo data - URL length: {len(data_url) if data_url else 0}, Label: {label}")
         
@@ -255,6 +298,27 @@ def add_photo():
         
         now = datetime.utcnow().isoformat()
         
+        # Look for near-duplicates taken shortly before (e.g. burst captures).
+        # This is best effort: a failure here must not stop the photo being saved.
+        dhash = None
+        duplicate_of = []
+        try:
+            dhash = compute_dhash(data_url)
+            if dhash is not None:
+                duplicate_of = photo_index.find_duplicates(dhash, now)
+        except Exception as e:
+            print(f"Duplicate check failed: {str(e)}")
+        
+        if duplicate_of and merge_duplicates:
+            print(f"Photo merged into existing photo {duplicate_of[0]}")
+            return jsonify({
+                'success': True,
+                'message': 'Photo matches an existing photo and was not saved again',
+                'merged': True,
+                'photo_id': duplicate_of[0],
+                'duplicate_of': duplicate_of
+            })
+        
         # Save to local database for backup
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
@@ -262,9 +326,20 @@ def add_photo():
             "INSERT INTO photos (data_url, label, taken_at, created_at) VALUES (?, ?, ?, ?)",
             (data_url, label, now, now)
         )
+        photo_id = cursor.lastrowid
+        cursor.execute(
+            "INSERT OR REPLACE INTO photo_hashes (id, dhash) VALUES (?, ?)",
+            (photo_id, encode_hash(dhash))
+        )
         conn.commit()
         conn.close()
         
+        if dhash is not None:
+            try:
+                photo_index.add(photo_id, dhash, now)
+            except Exception as e:
+                print(f"Could not index photo {photo_id}: {str(e)}")
+        
         print("Photo saved successfully to database")
         
         # Save to Google Calendar if authenticated
@@ -274,19 +349,25 @@ def add_photo():
                 return jsonify({
                     'success': True, 
                     'message': 'Photo added successfully to Google Calendar',
-                    'event_id': event_id
+                    'event_id': event_id,
+                    'photo_id': photo_id,
+                    'duplicate_of': duplicate_of
                 })
             except Exception as e:
                 return jsonify({
                     'success': True, 
                     'message': 'Photo added to local database but failed to save to Google Calendar',
-                    'error': str(e)
+                    'error': str(e),
+                    'photo_id': photo_id,
+                    'duplicate_of': duplicate_of
                 })
         else:
             return jsonify({
                 'success': True, 
                 'message': 'Photo added to local database. Connect to Google Calendar to sync.',
-                'needs_auth': True
+                'needs_auth': True,
+                'photo_id': photo_id,
+                'duplicate_of': duplicate_of
             })
         
     except Exception as e:
@@ -365,10 +446,12 @@ def ask_question():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
-    cursor.execute("SELECT title, artist, listened_at FROM songs")
+    visible, params = maintenance_manager.visible_filter('songs')
+    cursor.execute(f"SELECT title, artist, listened_at FROM songs WHERE {visible}", params)
     songs = cursor.fetchall()
     
-    cursor.execute("SELECT label, taken_at FROM photos")
+    visible, params = maintenance_manager.visible_filter('photos')
+    cursor.execute(f"SELECT label, taken_at FROM photos WHERE {visible}", params)
     photos = cursor.fetchall()
     
     conn.close()
@@ -408,21 +491,102 @@ def delete_photo(photo_id):
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute("DELETE FROM photos WHERE id = ?", (photo_id,))
+    cursor.execute("DELETE FROM photo_hashes WHERE id = ?", (photo_id,))
     conn.commit()
     conn.close()
+    photo_index.remove(photo_id)
+    
+    # Hand the freed pages back to the filesystem in the background
+    maintenance_manager.request_vacuum()
     return jsonify({'success': True, 'message': 'Photo deleted'})
 
+@app.route('/api/photos/duplicates', methods=['GET'])
+def get_duplicate_photos():
+    """List groups of near-duplicate photos, oldest photo first in each group"""
+    groups = photo_index.duplicate_groups()
+    
+    photos = {}
+    if groups:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        visible, params = maintenance_manager.visible_filter('photos')
+        cursor.execute(f"SELECT id, label, taken_at FROM photos WHERE {visible}", params)
+        for row in cursor.fetchall():
+            photos[row[0]] = {'id': row[0], 'label': row[1], 'taken_at': row[2]}
+        conn.close()
+    
+    # Image data is left out to keep the payload small; fetch it via /api/photos
+    result = []
+    for group in groups:
+        members = [photos[photo_id] for photo_id in group if photo_id in photos]
+        if len(members) > 1:
+            result.append({'keep': members[0], 'duplicates': members[1:]})
+    
+    return jsonify(result)
+
+@app.route('/api/photos/duplicates', methods=['DELETE'])
+def delete_duplicate_photos():
+    """Delete the selected near-duplicates; a group's kept photo is never deleted"""
+    data = request.get_json(silent=True)
+    photo_ids = data.get('photo_ids') if isinstance(data, dict) else None
+    if (
+        not isinstance(photo_ids, list) or not photo_ids
+        or not all(isinstance(photo_id, int) and not isinstance(photo_id, bool) for photo_id in photo_ids)
+    ):
+        return jsonify({'success': False, 'message': 'photo_ids must be a list of photo ids'}), 400
+    
+    photo_ids = list(dict.fromkeys(photo_ids))
+    
+    # Groups may have changed since the user reviewed them, so re-check every id
+    groups = photo_index.duplicate_groups()
+    deletable = {photo_id for group in groups for photo_id in group[1:]}
+    invalid_ids = [photo_id for photo_id in photo_ids if photo_id not in deletable]
+    if invalid_ids:
+        return jsonify({
+            'success': False,
+            'message': 'Some photos are not duplicates anymore. Refresh the duplicate list and try again.',
+            'invalid_ids': invalid_ids
+        }), 400
+    
+    # Rows are hidden immediately and deleted in chunks by the background worker
+    try:
+        maintenance_manager.schedule_delete(['photos', 'photo_hashes'], photo_ids)
+    except Exception as e:
+        print(f"Error scheduling duplicate delete: {str(e)}")
+        return jsonify({'success': False, 'message': f'Database error: {str(e)}'}), 500
+    
+    for photo_id in photo_ids:
+        photo_index.remove(photo_id)
+    
+    return jsonify({
+        'success': True,
+        'message': f'Deleted {len(photo_ids)} duplicate photos',
+        'deleted_ids': photo_ids
+    })
+
 @app.route('/api/clear-history', methods=['POST'])
 def clear_history():
     """Clear all history"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM songs")
-    cursor.execute("DELETE FROM photos")
-    conn.commit()
-    conn.close()
+    # Rows are hidden immediately and deleted in chunks by the background worker
+    try:
+        maintenance_manager.schedule_clear(['songs', 'photos', 'photo_hashes'])
+    except Exception as e:
+        print(f"Error scheduling history clear: {str(e)}")
+        return jsonify({'success': False, 'message': f'Database error: {str(e)}'}), 500
+    photo_index.reset()
     return jsonify({'success': True, 'message': 'History cleared'})
 
+@app.route('/api/admin/storage', methods=['GET'])
+def storage_status():
+    """Report database size and background cleanup progress"""
+    return jsonify(maintenance_manager.get_status())
+
+@app.route('/api/admin/storage/vacuum', methods=['POST'])
+def storage_vacuum():
+    """Trigger an incremental vacuum pass"""
+    maintenance_manager.request_vacuum()
+    return jsonify({'success': True, 'message': 'Incremental vacuum scheduled'})
+
 @app.route('/api/test-photo', methods=['GET'])
 def test_photo():
     """Test endpoint to verify photo saving works"""
@@ -434,13 +598,28 @@ def test_photo():
         cursor = conn.cursor()
         now = datetime.utcnow().isoformat()
         
+        try:
+            dhash = compute_dhash(test_data_url)
+        except Exception as e:
+            print(f"Could not hash test photo: {str(e)}")
+            dhash = None
+        
         cursor.execute(
             "INSERT INTO photos (data_url, label, taken_at, created_at) VALUES (?, ?, ?, ?)",
             (test_data_url, "Test Photo", now, now)
         )
+        photo_id = cursor.lastrowid
+        # Stored like add_photo so the photo reaches the duplicate index without a backfill
+        cursor.execute(
+            "INSERT OR REPLACE INTO photo_hashes (id, dhash) VALUES (?, ?)",
+            (photo_id, encode_hash(dhash))
+        )
         conn.commit()
         conn.close()
         
+        if dhash is not None:
+            photo_index.add(photo_id, dhash, now)
+        
         return jsonify({'success': True, 'message': 'Test photo saved successfully'})
         
     except Exception as e:
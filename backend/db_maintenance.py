@@ -0,0 +1,317 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# SQLite auto_vacuum modes (see PRAGMA auto_vacuum)
+AUTO_VACUUM_INCREMENTAL = 2
+
+# Rows removed per transaction when deleting in the background.
+DELETE_CHUNK_SIZE = 200
+
+# Freeing overflow pages dominates for large rows, so chunks of these tables
+# are also capped by the byte size of the listed column.
+DELETE_CHUNK_BYTES = 4 * 1024 * 1024
+CHUNK_SIZE_COLUMNS = {'photos': 'data_url'}
+
+# Pages returned to the filesystem per incremental_vacuum step.
+VACUUM_STEP_PAGES = 256
+
+# Seconds between periodic incremental_vacuum passes.
+VACUUM_INTERVAL = 300
+
+# Pause between chunks so request handlers can grab the writer lock.
+CHUNK_PAUSE = 0.05
+
+
+class StorageMaintenanceManager:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.status = {
+            'state': 'idle',
+            'job': None,
+            'tables': {},
+            'pages_reclaimed': 0,
+            'last_vacuum_at': None,
+            'error': None,
+        }
+
+    def _connect(self):
+        # Autocommit mode so each chunk and PRAGMA runs in its own transaction
+        return sqlite3.connect(self.db_path, isolation_level=None)
+
+    def migrate(self):
+        """Switch the database to incremental auto_vacuum if it isn't already"""
+        conn = self._connect()
+        try:
+            mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if mode != AUTO_VACUUM_INCREMENTAL:
+                # Changing auto_vacuum on an existing database only takes
+                # effect after a full VACUUM rebuilds the file.
+                print("Migrating database to auto_vacuum=INCREMENTAL...")
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+
+            # Queued clears survive restarts; rows with id <= max_id stay
+            # hidden until the worker has deleted them.
+            conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS pending_clears (
+                    table_name TEXT PRIMARY KEY,
+                    max_id INTEGER NOT NULL
+                )
+                '''
+            )
+
+            # Individual rows queued for deletion, hidden the same way
+            conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS pending_deletes (
+                    table_name TEXT NOT NULL,
+                    row_id INTEGER NOT NULL,
+                    PRIMARY KEY (table_name, row_id)
+                )
+                '''
+            )
+        finally:
+            conn.close()
+
+    def start(self):
+        """Start the background worker and resume any queued deletes"""
+        with self.lock:
+            if self.worker and self.worker.is_alive():
+                return
+            self.worker = threading.Thread(target=self._run, daemon=True)
+            self.worker.start()
+
+    def visible_filter(self, table, column='id'):
+        """Return a WHERE condition and params that hide rows queued for deletion"""
+        return (
+            f"{column} > COALESCE((SELECT max_id FROM pending_clears WHERE table_name = ?), 0) "
+            f"AND {column} NOT IN (SELECT row_id FROM pending_deletes WHERE table_name = ?)",
+            (table, table)
+        )
+
+    def schedule_clear(self, tables):
+        """Queue a chunked delete of every row currently in the given tables"""
+        conn = self._connect()
+        try:
+            # Read MAX(id) and record the job in one transaction so the
+            # rows are hidden exactly when the clear is durable.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table in tables:
+                    # "WHERE true" lets SQLite parse the upsert after a SELECT
+                    conn.execute(
+                        f"INSERT INTO pending_clears (table_name, max_id) "
+                        f"SELECT ?, COALESCE(MAX(id), 0) FROM {table} WHERE true "
+                        f"ON CONFLICT(table_name) DO UPDATE SET max_id = MAX(max_id, excluded.max_id)",
+                        (table,)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+        self.start()
+        self.wakeup.set()
+
+    def schedule_delete(self, tables, row_ids):
+        """Queue a chunked delete of the given ids from each of the tables"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table in tables:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO pending_deletes (table_name, row_id) VALUES (?, ?)",
+                        [(table, row_id) for row_id in row_ids]
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+        self.start()
+        self.wakeup.set()
+
+    def request_vacuum(self):
+        """Ask the worker to run an incremental_vacuum pass now"""
+        self.start()
+        self.wakeup.set()
+
+    def get_status(self):
+        """Return job progress together with current file and page stats"""
+        conn = self._connect()
+        try:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            pending_jobs = conn.execute("SELECT COUNT(*) FROM pending_clears").fetchone()[0]
+            pending_deletes = conn.execute("SELECT COUNT(*) FROM pending_deletes").fetchone()[0]
+        finally:
+            conn.close()
+
+        with self.lock:
+            status = dict(self.status)
+            status['tables'] = {name: dict(progress) for name, progress in self.status['tables'].items()}
+            status['pending_jobs'] = pending_jobs
+            status['pending_deletes'] = pending_deletes
+
+        status.update({
+            'auto_vacuum': auto_vacuum,
+            'page_size': page_size,
+            'page_count': page_count,
+            'freelist_count': freelist_count,
+            'free_bytes': freelist_count * page_size,
+            'file_size': os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0,
+        })
+        return status
+
+    def _run(self):
+        # The first pass runs immediately to resume clears queued before a restart
+        while True:
+            try:
+                # Jobs are only removed from the pending tables once their rows
+                # are gone, so a failed chunk is retried on the next pass.
+                self._clear_tables()
+                self._delete_rows()
+                self._incremental_vacuum()
+                self._set_status(state='idle', job=None, error=None)
+            except Exception as e:
+                print(f"Storage maintenance error: {e}")
+                self._set_status(state='error', error=str(e))
+            self.wakeup.wait(VACUUM_INTERVAL)
+            self.wakeup.clear()
+
+    def _set_status(self, **fields):
+        with self.lock:
+            self.status.update(fields)
+
+    def _size_expr(self, table, alias):
+        column = CHUNK_SIZE_COLUMNS.get(table)
+        return f"length({alias}.{column})" if column else "0"
+
+    def _take_chunk(self, cursor):
+        """Read (id, size) rows until DELETE_CHUNK_BYTES is reached, keeping at least one"""
+        # Rows are stepped one at a time so large values past the budget are never read
+        ids = []
+        total = 0
+        for row_id, size in cursor:
+            total += size or 0
+            if ids and total > DELETE_CHUNK_BYTES:
+                break
+            ids.append(row_id)
+        cursor.close()
+        return ids
+
+    def _delete_chunk(self, conn, table, ids, queued=False):
+        """Delete ids from table in one short write transaction"""
+        placeholders = ','.join('?' * len(ids))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+            if queued:
+                conn.execute(
+                    f"DELETE FROM pending_deletes WHERE table_name = ? AND row_id IN ({placeholders})",
+                    [table] + ids
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _clear_tables(self):
+        conn = self._connect()
+        try:
+            jobs = conn.execute("SELECT table_name, max_id FROM pending_clears").fetchall()
+            if not jobs:
+                return
+
+            tables = {}
+            for table, max_id in jobs:
+                remaining = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE id <= ?", (max_id,)).fetchone()[0]
+                tables[table] = {'total': remaining, 'deleted': 0}
+            self._set_status(state='deleting', job='clear', tables=tables)
+
+            for table, max_id in jobs:
+                while True:
+                    # Pick the chunk before taking the writer lock
+                    rows = conn.execute(
+                        f"SELECT t.id, {self._size_expr(table, 't')} FROM {table} t "
+                        f"WHERE t.id <= ? ORDER BY t.id LIMIT ?",
+                        (max_id, DELETE_CHUNK_SIZE)
+                    )
+                    ids = self._take_chunk(rows)
+                    if not ids:
+                        break
+                    self._delete_chunk(conn, table, ids)
+                    with self.lock:
+                        self.status['tables'][table]['deleted'] += len(ids)
+                    time.sleep(CHUNK_PAUSE)
+
+                # A newer clear may have raised max_id meanwhile; leave that job queued
+                conn.execute(
+                    "DELETE FROM pending_clears WHERE table_name = ? AND max_id = ?",
+                    (table, max_id)
+                )
+        finally:
+            conn.close()
+
+    def _delete_rows(self):
+        conn = self._connect()
+        try:
+            jobs = conn.execute("SELECT table_name, COUNT(*) FROM pending_deletes GROUP BY table_name").fetchall()
+            if not jobs:
+                return
+
+            tables = {table: {'total': total, 'deleted': 0} for table, total in jobs}
+            self._set_status(state='deleting', job='delete', tables=tables)
+
+            for table, _ in jobs:
+                while True:
+                    # Queue entries whose row is already gone still get removed
+                    rows = conn.execute(
+                        f"SELECT d.row_id, {self._size_expr(table, 't')} FROM pending_deletes d "
+                        f"LEFT JOIN {table} t ON t.id = d.row_id "
+                        f"WHERE d.table_name = ? ORDER BY d.row_id LIMIT ?",
+                        (table, DELETE_CHUNK_SIZE)
+                    )
+                    ids = self._take_chunk(rows)
+                    if not ids:
+                        break
+                    self._delete_chunk(conn, table, ids, queued=True)
+                    with self.lock:
+                        self.status['tables'][table]['deleted'] += len(ids)
+                    time.sleep(CHUNK_PAUSE)
+        finally:
+            conn.close()
+
+    def _incremental_vacuum(self):
+        conn = self._connect()
+        try:
+            freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if freelist_count:
+                self._set_status(state='vacuuming')
+            while freelist_count:
+                # The pragma frees pages one row at a time, so drain the cursor
+                conn.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})").fetchall()
+                remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                with self.lock:
+                    self.status['pages_reclaimed'] += freelist_count - remaining
+                if remaining >= freelist_count:
+                    break
+                freelist_count = remaining
+                time.sleep(CHUNK_PAUSE)
+            self._set_status(last_vacuum_at=datetime.utcnow().isoformat())
+        finally:
+            conn.close()
@@ -0,0 +1,232 @@
+import base64
+import io
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+from PIL import Image
+
+# Max differing bits (out of 64) for two photos to count as near-duplicates
+DUPLICATE_DISTANCE = 6
+
+# Only photos taken this close together are treated as the same shot
+DUPLICATE_WINDOW = timedelta(minutes=10)
+
+# Photos decoded per batch when backfilling hashes in the background
+BACKFILL_BATCH_SIZE = 20
+
+
+def compute_dhash(data_url):
+    """Compute a 64-bit difference hash for an image data URL"""
+    try:
+        encoded = data_url.split(',', 1)[1]
+        image = Image.open(io.BytesIO(base64.b64decode(encoded)))
+        # 9x8 grayscale gives 8 horizontal gradients per row
+        image = image.convert('L').resize((9, 8), Image.LANCZOS)
+    except Exception as e:
+        print(f"Could not hash photo: {e}")
+        return None
+
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big')
+
+
+def encode_hash(value):
+    # NULL marks photos that could not be hashed so they aren't retried
+    return format(value, '016x') if value is not None else None
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """Metric tree over hashes for Hamming-distance range queries"""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, photo_id):
+        if self.root is None:
+            self.root = [value, {photo_id}, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].add(photo_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, {photo_id}, {}]
+                return
+            node = child
+
+    def remove(self, value, photo_id):
+        # Emptied nodes stay in place so their subtrees remain reachable
+        node = self.root
+        while node is not None:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].discard(photo_id)
+                return
+            node = node[2].get(distance)
+
+    def search(self, value, max_distance):
+        """Return (photo_id, distance) pairs within max_distance of value"""
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results.extend((photo_id, distance) for photo_id in node[1])
+            # Triangle inequality: only children in this band can match
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+
+class PhotoHashIndex:
+    def __init__(self, db_path, maintenance_manager):
+        self.db_path = db_path
+        self.maintenance_manager = maintenance_manager
+        self.lock = threading.Lock()
+        self.tree = None
+        self.photos = {}
+        self.backfill_worker = None
+
+    def reset(self):
+        """Drop the in-memory index; it is rebuilt from the database on next use"""
+        with self.lock:
+            self.tree = None
+            self.photos = {}
+
+    def start_backfill(self):
+        """Hash photos stored before the index existed on a background thread"""
+        if self.backfill_worker and self.backfill_worker.is_alive():
+            return
+        self.backfill_worker = threading.Thread(target=self._backfill, daemon=True)
+        self.backfill_worker.start()
+
+    def _backfill(self):
+        try:
+            while True:
+                conn = sqlite3.connect(self.db_path)
+                cursor = conn.cursor()
+                visible, params = self.maintenance_manager.visible_filter('photos', 'p.id')
+                cursor.execute(
+                    f"SELECT p.id, p.data_url, p.taken_at FROM photos p "
+                    f"LEFT JOIN photo_hashes h ON h.id = p.id "
+                    f"WHERE h.id IS NULL AND {visible} LIMIT ?",
+                    params + (BACKFILL_BATCH_SIZE,)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    conn.close()
+                    break
+
+                hashed = [(photo_id, compute_dhash(data_url), taken_at) for photo_id, data_url, taken_at in rows]
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO photo_hashes (id, dhash) VALUES (?, ?)",
+                    [(photo_id, encode_hash(value)) for photo_id, value, _ in hashed]
+                )
+                conn.commit()
+                conn.close()
+
+                for photo_id, value, taken_at in hashed:
+                    if value is not None:
+                        self.add(photo_id, value, taken_at)
+            print("Photo hash backfill complete")
+        except Exception as e:
+            print(f"Photo hash backfill error: {e}")
+
+    def _ensure_loaded(self):
+        if self.tree is not None:
+            return
+
+        # Only hashes already stored are indexed; missing ones come from the backfill
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        visible, params = self.maintenance_manager.visible_filter('photos', 'p.id')
+        cursor.execute(
+            f"SELECT h.id, h.dhash, p.taken_at FROM photo_hashes h "
+            f"JOIN photos p ON p.id = h.id WHERE h.dhash IS NOT NULL AND {visible}",
+            params
+        )
+        rows = cursor.fetchall()
+        conn.close()
+
+        self.tree = BKTree()
+        self.photos = {}
+        for photo_id, dhash, taken_at in rows:
+            self._add(photo_id, int(dhash, 16), taken_at)
+
+    def _add(self, photo_id, value, taken_at):
+        self.tree.add(value, photo_id)
+        self.photos[photo_id] = (value, datetime.fromisoformat(taken_at))
+
+    def _neighbours(self, value, taken_at, exclude=None):
+        matches = []
+        for photo_id, distance in self.tree.search(value, DUPLICATE_DISTANCE):
+            if photo_id == exclude:
+                continue
+            if abs(self.photos[photo_id][1] - taken_at) <= DUPLICATE_WINDOW:
+                matches.append((photo_id, distance))
+        return sorted(matches, key=lambda match: (match[1], match[0]))
+
+    def find_duplicates(self, value, taken_at):
+        """Return ids of indexed photos that look like the given hash"""
+        with self.lock:
+            self._ensure_loaded()
+            moment = datetime.fromisoformat(taken_at)
+            return [photo_id for photo_id, _ in self._neighbours(value, moment)]
+
+    def add(self, photo_id, value, taken_at):
+        """Index a photo whose hash row has already been committed"""
+        with self.lock:
+            if self.tree is not None:
+                self._add(photo_id, value, taken_at)
+
+    def remove(self, photo_id):
+        with self.lock:
+            if self.tree is None or photo_id not in self.photos:
+                return
+            value, _ = self.photos.pop(photo_id)
+            self.tree.remove(value, photo_id)
+
+    def duplicate_groups(self):
+        """Group indexed photos into near-duplicates of their oldest photo
+
+        Each group is led by its oldest photo and every other member is
+        within DUPLICATE_DISTANCE and DUPLICATE_WINDOW of that leader, so
+        groups never grow by chaining through neighbours.
+        """
+        with self.lock:
+            self._ensure_loaded()
+            ordered = sorted(
+                self.photos,
+                key=lambda photo_id: (self.photos[photo_id][1], photo_id)
+            )
+
+            assigned = set()
+            groups = []
+            for leader_id in ordered:
+                if leader_id in assigned:
+                    continue
+                assigned.add(leader_id)
+                value, taken_at = self.photos[leader_id]
+                members = [
+                    photo_id
+                    for photo_id, _ in self._neighbours(value, taken_at, exclude=leader_id)
+                    if photo_id not in assigned
+                ]
+                if members:
+                    assigned.update(members)
+                    members.sort(key=lambda photo_id: (self.photos[photo_id][1], photo_id))
+                    groups.append([leader_id] + members)
+
+            return groups